@@ -1,12 +1,130 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from types import SimpleNamespace
+
 import osmnx as ox
 import pandas as pd
+import requests
+import shapely
 from shapely.geometry import Point
 import geopandas as gpd
 
-def fetch_zabka_shops_wroclaw():
+# Directory for cached Overpass results (one parquet file per query)
+CACHE_DIR = './cache'
+
+# Retries for raw Overpass queries rejected as rate-limited (429) or overloaded (504)
+OVERPASS_RETRIES = 3
+OVERPASS_RETRY_PAUSE = 60
+
+def use_fast_json_decoder():
+    """
+    Decode HTTP JSON responses (including Overpass query results)
+    with orjson when it is installed; otherwise keep the stdlib json module.
+    """
+    try:
+        import orjson
+        import requests.models
+    except ImportError:
+        return
+    
+    stdlib_json = requests.models.complexjson
+    
+    def loads(s, **kwargs):
+        # orjson takes no decoder options, so honour any the caller passed
+        if kwargs:
+            return stdlib_json.loads(s, **kwargs)
+        return orjson.loads(s)
+    
+    requests.models.complexjson = SimpleNamespace(loads=loads, dumps=stdlib_json.dumps)
+
+def cached_gdf(key_data, fetch, ttl):
+    """
+    Return the GeoDataFrame cached under key_data if it is younger than ttl
+    seconds; otherwise call fetch() and cache its result as parquet.
+    """
+    key = hashlib.sha1(json.dumps(key_data, sort_keys=True).encode('utf-8')).hexdigest()
+    cache_path = os.path.join(CACHE_DIR, f"{key}.parquet")
+    
+    if os.path.exists(cache_path) and time.time() - os.path.getmtime(cache_path) < ttl:
+        try:
+            return gpd.read_parquet(cache_path)
+        except Exception as e:
+            # An unreadable cache file is treated as a miss and refetched
+            print(f"Warning: couldn't read cached results from {cache_path}: {e}")
+    
+    gdf = fetch()
+    
+    # Write to a temporary file first so an interrupted write never leaves
+    # a truncated file at cache_path
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        gdf.to_parquet(tmp_path)
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        # A failed cache write shouldn't break the fetch itself
+        print(f"Warning: couldn't cache results to {cache_path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    
+    return gdf
+
+def cached_overpass_query(query, ttl=24 * 60 * 60):
+    """
+    Run a raw Overpass QL query ending in 'out center;' and return its elements
+    as a GeoDataFrame of points (ways and relations are placed at their center),
+    reusing a cached result younger than ttl seconds.
+    """
+    def fetch():
+        # Use the same endpoint and identifying headers osmnx uses for its own requests
+        url = ox.settings.overpass_url.rstrip('/') + '/interpreter'
+        headers = {
+            'User-Agent': ox.settings.http_user_agent,
+            'referer': ox.settings.http_referer,
+            'Accept-Language': ox.settings.http_accept_language
+        }
+        
+        for attempt in range(OVERPASS_RETRIES + 1):
+            response = requests.post(
+                url, data={'data': query}, headers=headers, timeout=ox.settings.requests_timeout
+            )
+            if response.status_code not in (429, 504) or attempt == OVERPASS_RETRIES:
+                break
+            pause = OVERPASS_RETRY_PAUSE * (attempt + 1)
+            print(f"Overpass is busy (HTTP {response.status_code}), retrying in {pause}s...")
+            time.sleep(pause)
+        
+        response.raise_for_status()
+        data = response.json()
+        
+        # Overpass reports timeouts and runtime errors as a remark on an HTTP 200
+        # response whose elements are incomplete, so don't let it reach the cache
+        if 'remark' in data:
+            raise RuntimeError(f"Overpass returned an incomplete result: {data['remark']}")
+        
+        elements = data['elements']
+        
+        coords = [el if 'lat' in el else el.get('center', {}) for el in elements]
+        index = pd.MultiIndex.from_arrays(
+            [[el['type'] for el in elements], [el['id'] for el in elements]],
+            names=['element', 'id']
+        )
+        geometry = gpd.points_from_xy(
+            [c.get('lon') for c in coords], [c.get('lat') for c in coords]
+        )
+        tags = pd.DataFrame([el.get('tags', {}) for el in elements], index=index)
+        return gpd.GeoDataFrame(tags, geometry=geometry, crs='EPSG:4326')
+    
+    return cached_gdf(['overpass', query], fetch, ttl)
+
+def fetch_zabka_shops_wroclaw(filename='zabka_shops_wroclaw.xlsx'):
     """
     Fetch all Żabka shops in Wrocław, Poland from OpenStreetMap
     and save them to an Excel file with longitude, latitude, name, and address columns.
+    A filename ending in .parquet writes a Parquet file instead.
     """
     
     # Define the place (Wrocław, Poland)
@@ -17,48 +135,50 @@ def fetch_zabka_shops_wroclaw():
     try:
         # Get the boundary of Wrocław
         wroclaw_boundary = ox.geocode_to_gdf(place_name)
+        left, bottom, right, top = wroclaw_boundary.total_bounds
         print("✓ Successfully fetched Wrocław boundary")
     except Exception as e:
         print(f"Error fetching boundary: {e}")
         return
     
-    # Define tags to search for Żabka shops
-    # We'll search for various combinations that might identify Żabka stores
-    tags = {
-        'shop': 'convenience',
-        'name': 'Żabka'
-    }
+    # Search by name regardless of tagging (convenience shop, other shop, or none),
+    # so one small Overpass request covers what used to take three fallback queries.
+    # Query the city's bbox, which Overpass evaluates more cheaply than an area filter;
+    # Overpass bboxes are (south, west, north, east). 'out center' gives ways and
+    # relations a single coordinate
+    query = (
+        f'[out:json][timeout:{ox.settings.requests_timeout}];'
+        f'nwr["name"~"[Żż]abka",i]({bottom},{left},{top},{right});'
+        'out center;'
+    )
     
     print("Searching for Żabka shops...")
     
     try:
-        # Fetch POIs (points of interest) - this gets both nodes and ways
-        pois = ox.features_from_place(place_name, tags)
+        # Fetch POIs (points of interest) - this gets nodes, ways and relations
+        # The boundary join below drops the few bbox results outside the city
+        pois = cached_overpass_query(query)
         print(f"✓ Found {len(pois)} potential matches")
         
+        if pois.empty:
+            print("No Żabka shops found in Wrocław.")
+            return
+        
+        # Keep only the columns used below; OSM results carry hundreds of tag columns
+        keep = ['geometry', 'name', 'addr:street', 'addr:housenumber']
+        pois = pois[[c for c in keep if c in pois.columns]]
+        
         # Filter for entries that actually contain "Żabka" in the name
-        zabka_mask = pois['name'].astype(str).str.contains('Żabka|żabka', case=False, na=False)
-        zabka_shops = pois[zabka_mask].copy()
+        zabka_mask = pois['name'].str.contains('żabka', case=False, na=False, regex=False)
+        zabka_shops = pois[zabka_mask]
         
         print(f"✓ Filtered to {len(zabka_shops)} Żabka shops")
         
-        if len(zabka_shops) == 0:
-            print("No Żabka shops found. Trying alternative search...")
-            
-            # Try a broader search
-            alternative_tags = {'name': ['Żabka', 'żabka']}
-            pois_alt = ox.features_from_place(place_name, alternative_tags)
-            zabka_shops = pois_alt.copy()
-            print(f"✓ Alternative search found {len(zabka_shops)} results")
-        
-        if len(zabka_shops) == 0:
-            print("Still no results. Trying shop-specific search...")
-            # One more attempt with just shop tag
-            shop_tags = {'shop': True}
-            all_shops = ox.features_from_place(place_name, shop_tags)
-            zabka_mask = all_shops['name'].astype(str).str.contains('Żabka|żabka', case=False, na=False)
-            zabka_shops = all_shops[zabka_mask].copy()
-            print(f"✓ Shop-specific search found {len(zabka_shops)} Żabka shops")
+        # Keep only shops inside the city boundary; sjoin runs the predicate
+        # through the STRtree spatial index rather than testing shop by shop
+        zabka_shops = gpd.sjoin(
+            zabka_shops, wroclaw_boundary[['geometry']], predicate='intersects', how='inner'
+        ).drop(columns='index_right')
         
     except Exception as e:
         print(f"Error fetching POI data: {e}")
@@ -71,68 +191,49 @@ def fetch_zabka_shops_wroclaw():
         print("3. Shops tagged differently than expected")
         return
     
-    # Prepare data for Excel export
-    shop_data = []
-    
     print("Processing shop geometries...")
     
-    for idx, shop in zabka_shops.iterrows():
-        try:
-            # Get the geometry
-            geom = shop.geometry
-            
-            # Calculate centroid for both points and polygons
-            if geom.geom_type == 'Point':
-                lon, lat = geom.x, geom.y
-            elif geom.geom_type in ['Polygon', 'MultiPolygon']:
-                centroid = geom.centroid
-                lon, lat = centroid.x, centroid.y
-            else:
-                # For other geometry types, try to get centroid
-                centroid = geom.centroid
-                lon, lat = centroid.x, centroid.y
-            
-            # Extract relevant information
-            name = shop.get('name', 'Żabka')
-            
-            # Try to get address information in Polish format (street + house number)
-            street = shop.get('addr:street', '')
-            house_number = shop.get('addr:housenumber', '')
-            
-            if street and house_number:
-                address = f"{street} {house_number}"
-            elif street:
-                address = street
-            else:
-                address = 'Adres niedostępny'
-            
-            shop_data.append({
-                'geographical_longitude': lon,
-                'geographical_latitude': lat,
-                'address': address,
-                'name': name
-            })
-            
-        except Exception as e:
-            print(f"Error processing shop {idx}: {e}")
-            continue
+    # The Overpass query returns one point per shop ('out center' places ways
+    # and relations at their center), so coordinates can be read off directly
+    lon = shapely.get_x(zabka_shops.geometry.values)
+    lat = shapely.get_y(zabka_shops.geometry.values)
     
-    if not shop_data:
-        print("No valid shop data could be processed.")
-        return
+    # Build addresses in Polish format (street + house number)
+    no_value = pd.Series('', index=zabka_shops.index)
+    street = zabka_shops.get('addr:street', no_value).fillna('').astype(str)
+    house_number = zabka_shops.get('addr:housenumber', no_value).fillna('').astype(str)
+    address = street.where(house_number == '', street + ' ' + house_number)
+    address = address.where(street != '', 'Adres niedostępny')
+    
+    name = zabka_shops['name'].fillna('Żabka')
     
     # Create DataFrame
-    df = pd.DataFrame(shop_data)
+    df = pd.DataFrame({
+        'geographical_longitude': lon,
+        'geographical_latitude': lat,
+        'address': address.values,
+        'name': name.values
+    })
+    
+    # Skip shops whose geometry couldn't be processed (e.g. empty geometries)
+    df = df.dropna(subset=['geographical_longitude', 'geographical_latitude'])
+    
+    if df.empty:
+        print("No valid shop data could be processed.")
+        return
     
     # Sort by longitude for consistent ordering
     df = df.sort_values('geographical_longitude').reset_index(drop=True)
     
     print(f"✓ Processed {len(df)} shops successfully")
     
-    # Save to Excel
-    filename = 'zabka_shops_wroclaw.xlsx'
+    # Save to Excel (or Parquet, which is much faster and smaller on disk)
     try:
-        df.to_excel(filename, index=False, engine='openpyxl')
+        if filename.endswith('.parquet'):
+            df.to_parquet(filename, index=False)
+        else:
+            # xlsxwriter is a write-only engine and avoids openpyxl's workbook object model
+            df.to_excel(filename, index=False, engine='xlsxwriter')
         print(f"✓ Data saved to {filename}")
         
         # Display summary
@@ -146,12 +247,17 @@ def fetch_zabka_shops_wroclaw():
         print(df.head().to_string(index=False))
         
     except Exception as e:
-        print(f"Error saving to Excel: {e}")
+        print(f"Error saving to {filename}: {e}")
         print("Data collected successfully but couldn't save to file.")
         return df
 
 def main():
     """Main function to run the Żabka shop fetcher"""
+    parser = argparse.ArgumentParser(description="Fetch Żabka shops in Wrocław from OpenStreetMap")
+    parser.add_argument('output', nargs='?', default='zabka_shops_wroclaw.xlsx',
+                        help="output file; .xlsx writes Excel, .parquet writes Parquet")
+    args = parser.parse_args()
+    
     print("Żabka Shop Fetcher for Wrocław, Poland")
     print("=" * 40)
     
@@ -159,16 +265,26 @@ def main():
     try:
         import osmnx
         import pandas
-        import openpyxl
+        import xlsxwriter
+        import pyarrow
         print("✓ All required packages available")
     except ImportError as e:
         print(f"Missing required package: {e}")
         print("Please install required packages:")
-        print("pip install osmnx pandas openpyxl")
+        print("pip install 'osmnx>=2' pandas xlsxwriter pyarrow")
         return
     
+    # Process-wide settings are applied here rather than at import, so other
+    # scripts importing this module keep stock osmnx and requests behaviour
+    
+    # Let osmnx cache its own HTTP responses (the Nominatim boundary lookup) between runs
+    ox.settings.use_cache = True
+    ox.settings.cache_folder = './osmnx_cache'
+    
+    use_fast_json_decoder()
+    
     # Run the fetcher
-    result = fetch_zabka_shops_wroclaw()
+    result = fetch_zabka_shops_wroclaw(args.output)
     
     if result is not None:
         print("\n✓ Program completed successfully!")